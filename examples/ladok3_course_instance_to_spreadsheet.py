@@ -34,30 +34,53 @@
 #
 # Add the "-T" flag to run in the Ladok test environment.
 #
+# Add the "--cache" flag to keep the Canvas responses on disk for an hour (requires requests-cache),
+# and "--refresh-cache" to start from an empty cache.
+#
+# Add "--format csv" or "--format parquet" to write the table in that format instead of as a spreadsheet.
+#
 #
 # Adapted to work with the ladok3 python package and also adapted to the change in the shift from integration_id to sis_course_id
 # 
 # last modified: 2022-0819
 #
 
+import appdirs
 import ladok3,  pprint
 import requests, time
+import urllib3
+import concurrent.futures
+import functools
 import json
+import os
 import optparse
+import re
 import sys
+import urllib.parse
 import pandas as pd
 
 import datetime
-
-pp = pprint.PrettyPrinter(indent=4)
+import getpass
 
 global canvas_baseUrl	# the base URL used for access to Canvas
 global canvas_header	# the header for all HTML requests
 global canvas_payload	# place to store additionally payload when needed for options to HTML requests
+global canvas_session	# the session for all requests to Canvas, it keeps the connections alive
+
+
+canvas_rate_limit_threshold=100	# below this X-Rate-Limit-Remaining we slow down
 
+def canvas_throttle(r, *args, **kwargs):
+    # back off a little while Canvas's request cost bucket refills
+    remaining=r.headers.get('X-Rate-Limit-Remaining')
+    if remaining is not None and float(remaining) < canvas_rate_limit_threshold:
+        if Verbose_Flag:
+            print("X-Rate-Limit-Remaining is {}, slowing down".format(remaining))
+        time.sleep(1)
+    return r
 
 def initialize(options):
-    global canvas_baseUrl, canvas_header, canvas_payload
+    global canvas_baseUrl, canvas_header, canvas_payload, canvas_session
 
     if options.config_filename:
         config_file=options.config_filename
@@ -77,6 +100,30 @@ def initialize(options):
 
             canvas_header = {'Authorization' : 'Bearer ' + canvas_access_token}
             canvas_payload = {}
+            canvas_session = None
+            if options.cache:
+                # optionally keep the Canvas GET responses on disk, handy when re-running the program
+                try:
+                    import requests_cache
+                    canvas_session = requests_cache.CachedSession('.canvas_cache', backend='sqlite',
+                                                                  expire_after=3600,
+                                                                  allowable_methods=('GET',))
+                    if options.refresh_cache:
+                        canvas_session.cache.clear()
+                except ImportError:
+                    print("requests-cache is not installed, continuing without a cache")
+            if canvas_session is None:
+                canvas_session = requests.Session()
+            canvas_session.headers.update(canvas_header)
+            # retry throttled (429) and temporarily failing requests with exponential backoff,
+            # Canvas's 403 throttling is handled by slowing down in canvas_throttle
+            canvas_retries=urllib3.util.Retry(total=5, backoff_factor=0.5,
+                                              status_forcelist=[429, 502, 503, 504],
+                                              respect_retry_after_header=True,
+                                              raise_on_status=False)
+            canvas_session.mount('https://', requests.adapters.HTTPAdapter(max_retries=canvas_retries))
+            canvas_session.mount('http://', requests.adapters.HTTPAdapter(max_retries=canvas_retries))
+            canvas_session.hooks['response'].append(canvas_throttle)
 
             # set up Ladok access
             username=configuration["ladok"]["username"]
@@ -90,15 +137,35 @@ def initialize(options):
         password=getpass.getpass(prompt='Password (for Ladok access): ')
     ls=ladok3.LadokSession("KTH",
                            vars={"username": username, "password": password},
-                           options.testenvironment)
+                           test_environment=options.testenvironment)
     return ls
 
 
 #//////////////////////////////////////////////////////////////////////
 # Canvas related routines
 #//////////////////////////////////////////////////////////////////////
+def get_all_pages(url, extra_parameters=None):
+    results_found_thus_far=[]
+    r = canvas_session.get(url, params=extra_parameters)
+    if Verbose_Flag:
+        print("result of getting {0}: {1}".format(url, r.text))
+
+    if r.status_code == requests.codes.ok:
+        results_found_thus_far.extend(ladok3.json_loads(r.content))
+
+        # the following is needed when the reponse has been paginated
+        # i.e., when the response is split into pieces - each returning only some of the list
+        # see "Handling Pagination" - Discussion created by tyler.clair@usu.edu on Apr 27, 2015, https://community.canvaslms.com/thread/1500
+        # the URL of the next page keeps the parameters, e.g., per_page, of the first request
+        while r.links.get('next', False):
+            r = canvas_session.get(r.links['next']['url'])
+            if Verbose_Flag:
+                print("result of getting a paginated response: {}".format(r.text))
+            results_found_thus_far.extend(ladok3.json_loads(r.content))
+
+    return results_found_thus_far
+
 def users_in_course(course_id):
-    users_found_thus_far=[]
     # Use the Canvas API to get the list of users enrolled in this course
     #GET /api/v1/courses/:course_id/enrollments
 
@@ -109,25 +176,9 @@ def users_in_course(course_id):
     extra_parameters={'per_page': '100',
                       'type': ['StudentEnrollment']
     }
-    r = requests.get(url, params=extra_parameters, headers = canvas_header)
-    if Verbose_Flag:
-        print("result of getting enrollments: {}".format(r.text))
-
-    if r.status_code == requests.codes.ok:
-        page_response=r.json()
-
-        for p_response in page_response:  
-            users_found_thus_far.append(p_response)
-
-        # the following is needed when the reponse has been paginated
-        while r.links.get('next', False):
-            r = requests.get(r.links['next']['url'], headers=canvas_header)
-            page_response = r.json()  
-            for p_response in page_response:  
-                users_found_thus_far.append(p_response)
-
-    return users_found_thus_far
+    return get_all_pages(url, extra_parameters)
 
+@functools.lru_cache(maxsize=4096)
 def canvas_user_from_integration_id(integration_id):
     # Use the Canvas API to get the user's informatio
     #GET /api/v1/users/sis_integration_id:xxxxxxx
@@ -138,17 +189,16 @@ def canvas_user_from_integration_id(integration_id):
 
     extra_parameters={'per_page': '100',
     }
-    r = requests.get(url, params=extra_parameters, headers = canvas_header)
+    r = canvas_session.get(url, params=extra_parameters)
     if Verbose_Flag:
         print("result of getting user: {}".format(r.text))
 
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return ladok3.json_loads(r.content)
 
     return None
 
 def teachers_in_course(course_id):
-    users_found_thus_far=[]
     # Use the Canvas API to get the list of users enrolled in this course
     #GET /api/v1/courses/:course_id/enrollments
 
@@ -159,24 +209,7 @@ def teachers_in_course(course_id):
     extra_parameters={'per_page': '100',
                       'type': ['TeacherEnrollment']
     }
-    r = requests.get(url, params=extra_parameters, headers = canvas_header)
-    if Verbose_Flag:
-        print("result of getting enrollments: {}".format(r.text))
-
-    if r.status_code == requests.codes.ok:
-        page_response=r.json()
-
-        for p_response in page_response:  
-            users_found_thus_far.append(p_response)
-
-        # the following is needed when the reponse has been paginated
-        while r.links.get('next', False):
-            r = requests.get(r.links['next']['url'], headers=canvas_header)
-            page_response = r.json()  
-            for p_response in page_response:  
-                users_found_thus_far.append(p_response)
-
-    return users_found_thus_far
+    return get_all_pages(url, extra_parameters)
 
 def course_info(course_id):
     # Use the Canvas API to get information for the course
@@ -186,17 +219,16 @@ def course_info(course_id):
     if Verbose_Flag:
         print("url: {}".format(url))
 
-    r = requests.get(url, headers = canvas_header)
+    r = canvas_session.get(url)
     if Verbose_Flag:
         print("result of getting course: {}".format(r.text))
 
     if r.status_code == requests.codes.ok:
-        page_response=r.json()
+        page_response=ladok3.json_loads(r.content)
         return page_response
     return None
 
 def list_dashboard_cards():
-    cards_found_thus_far=[]
     # Use the Canvas API to get the list of dashboard cards
     #GET /api/v1/dashboard/dashboard_cards
 
@@ -204,28 +236,7 @@ def list_dashboard_cards():
     if Verbose_Flag:
         print("url: {}".format(url))
 
-    r = requests.get(url, headers = canvas_header)
-    if Verbose_Flag:
-        print("result of getting dashboard cards: {}".format(r.text))
-
-    if r.status_code == requests.codes.ok:
-        page_response=r.json()
-
-        for p_response in page_response:  
-            cards_found_thus_far.append(p_response)
-
-            # the following is needed when the reponse has been paginated
-            # i.e., when the response is split into pieces - each returning only some of the list of files
-            # see "Handling Pagination" - Discussion created by tyler.clair@usu.edu on Apr 27, 2015, https://community.canvaslms.com/thread/1500
-        while r.links.get('next', False):
-            r = requests.get(r.links['next']['url'], headers=header)  
-            if Verbose_Flag:
-                print("result of getting files for a paginated response: {}".format(r.text))
-            page_response = r.json()  
-            for p_response in page_response:  
-                cards_found_thus_far.append(p_response)
-
-    return cards_found_thus_far
+    return get_all_pages(url)
 
 #//////////////////////////////////////////////////////////////////////
 # Ladok related routines
@@ -251,33 +262,38 @@ def collect_study_info_from_child(child):
         for bb in child['Barn']:
             bi.extend(collect_study_info_from_child(bb))
     else:
+        # walk down to the session information once
+        participation=child['Tillfallesdeltagande']
+        info=participation['Utbildningsinformation']
+        names=info['Benamning']
+
         bd=dict()
-        bd['program_code']=child['Tillfallesdeltagande']['Utbildningsinformation']['Utbildningskod']
-        check_for_english_program_name=child['Tillfallesdeltagande']['Utbildningsinformation']['Benamning'].get('en', False)
-        if check_for_english_program_name:
-            bd['program_name']=child['Tillfallesdeltagande']['Utbildningsinformation']['Benamning']['en']
-        else:
-            bd['program_name']=child['Tillfallesdeltagande']['Utbildningsinformation']['Benamning']['sv']
+        bd['program_code']=info['Utbildningskod']
+        bd['program_name']=names.get('en')
+        if not bd['program_name']:
+            bd['program_name']=names['sv']
             print("*** No English program name for {}".format(bd['program_name']))
 
-        bd['program_study_period']=child['Tillfallesdeltagande']['Utbildningsinformation']['Studieperiod']
-        bd['program_session_code']=child['Tillfallesdeltagande']['Utbildningsinformation']['Utbildningstillfalleskod']
-        bd['program_type_code']=child['Tillfallesdeltagande']['Utbildningsinformation']['Utbildningstillfallestyp']['Kod']
-        bd['program_session_cancelled']=child['Tillfallesdeltagande']['Aterbud']
-        bd['program_session_completed']=child['Tillfallesdeltagande']['Avklarad']
+        bd['program_study_period']=info['Studieperiod']
+        bd['program_session_code']=info['Utbildningstillfalleskod']
+        bd['program_type_code']=info['Utbildningstillfallestyp']['Kod']
+        bd['program_session_cancelled']=participation['Aterbud']
+        bd['program_session_completed']=participation['Avklarad']
 
         if Verbose_Flag:
             print("bd={}".format(bd))
         bi.append(bd)
     return bi
 
+# the result is cached, so callers must not modify the returned list
+@functools.lru_cache(maxsize=4096)
 def specialization_info(ls, student_uid):
     s1=ls.studystructure_student_JSON(student_uid)
     ss1=s1['Studiestrukturer']
 
     # a student who is not in a program will have s1 == {'Studiestrukturer': [], 'link': []}
     if not ss1:
-        return ["Self-contained courses - no program"]
+        return []
 
 
     #print("s1={}".format(s1))
@@ -323,9 +339,41 @@ def specialization_info(ls, student_uid):
 
 
 
+# the types of education hardly ever change, so keep a copy on disk for a week
+# in the same cache directory as the ladok command, one file per Ladok environment
+types_of_education_cache_dir=appdirs.AppDirs("ladok", "dbosk@kth.se").user_cache_dir
+types_of_education_max_age=7*24*60*60
+
+# returns a dict mapping the code of a type of education to (English name, Swedish name)
+@functools.lru_cache(maxsize=1)
+def types_of_education_info(ls):
+    types_of_education_cache_file=os.path.join(types_of_education_cache_dir,
+                                               "utbildningstyp-{}.json".format(urllib.parse.urlparse(ls.base_url).netloc))
+    try:
+        if time.time() - os.path.getmtime(types_of_education_cache_file) < types_of_education_max_age:
+            with open(types_of_education_cache_file) as json_data_file:
+                utbildningstyp=json.load(json_data_file)
+        else:
+            utbildningstyp=None
+    except (OSError, ValueError):
+        utbildningstyp=None
+
+    if utbildningstyp is None:
+        utbildningstyp=ls.utbildningstyp_JSON()
+        try:
+            os.makedirs(os.path.dirname(types_of_education_cache_file), exist_ok=True)
+            with open(types_of_education_cache_file, 'w') as json_data_file:
+                json.dump(utbildningstyp, json_data_file)
+        except OSError:
+            if Verbose_Flag:
+                print("Unable to write {}".format(types_of_education_cache_file))
+
+    return {i['Kod']: (i['Benamning']['en'], i['Benamning']['sv'])
+            for i in utbildningstyp['Utbildningstyp']}
+
 # cleanup the session and then exit
 def clean_exit(ls):
-    status=ls.logout()
+    ls.session.close()              # LadokSession has no logout, closing the session drops its connections
     sys.exit()
 
 #//////////////////////////////////////////////////////////////////////
@@ -334,63 +382,58 @@ def clean_exit(ls):
 # set up the output write
 def write_xlsx(file_name, df, sheet_name):
     writer = pd.ExcelWriter(file_name+'.xlsx', engine='xlsxwriter')
-    df.to_excel(writer, sheet_name=sheet_name)
+    df.to_excel(writer, sheet_name=sheet_name, index=False)
     # Close the Pandas Excel writer and output the Excel file.
-    writer.save()
+    writer.close()
+
+# a card's assetString is of the form course_<course_id>
+assetString_regex=re.compile(r'^course_(\d+)$', re.ASCII)
 
 def course_id_from_assetString(card):
     global Verbose_Flag
 
-    course_id=card['assetString']
-    if len(course_id) > 7:
-        if course_id.startswith('course_'):
-            course_id=course_id.replace('course_', "", 1)
-            if Verbose_Flag:
-                print("course_id_from_assetString:: course_id={}".format(course_id))
-            return course_id
-    else:
+    m=assetString_regex.match(card.get('assetString', ''))
+    if not m:
         print("Error missing assetString for card {}".format(card))
         return None
 
+    course_id=m.group(1)
+    if Verbose_Flag:
+        print("course_id_from_assetString:: course_id={}".format(course_id))
+    return course_id
+
 # check if the course_id is all digits, matches course code, or matches a short_name
 def process_course_id_from_commandLine(course_id):
     if not course_id.isdigit():
         cards=list_dashboard_cards()
+        # index the cards on their course code, short name, and original name, the first card wins
+        cards_by_name=dict()
         for c in cards:
-            # look to see if the string is a course_code
-            if course_id == c['courseCode']:
-                course_id=course_id_from_assetString(c)
-                break
-            # check for matched against shortName
-            if course_id == c['shortName']:
-                course_id=course_id_from_assetString(c)
-                break
-            # look for the string at start of the shortName
-            if c['shortName'].startswith(course_id) > 0:
-                course_id=course_id_from_assetString(c)
+            for key in ['courseCode', 'shortName', 'originalName']:
+                cards_by_name.setdefault((key, c[key]), c)
+
+        # look for an exact match
+        c=cards_by_name.get(('courseCode', course_id)) or \
+            cards_by_name.get(('shortName', course_id)) or \
+            cards_by_name.get(('originalName', course_id))
+        # look for the string at the start of the names
+        if not c:
+            c=next((c for c in cards
+                    if c['shortName'].startswith(course_id) or c['originalName'].startswith(course_id)),
+                   None)
+            if c:
                 print("picked the course {} based on the starting match".format(c['shortName']))
-                break
-            # look for the substring in the shortName
-            if c['shortName'].find(course_id) > 0:
-                course_id=course_id_from_assetString(c)
+        # look for the substring in the names
+        if not c:
+            c=next((c for c in cards
+                    if course_id in c['shortName'] or course_id in c['originalName']),
+                   None)
+            if c:
                 print("picked the course {} based on partial match".format(c['shortName']))
-                break
-
-            # check for matched against originalName
-            if course_id == c['originalName']:
-                course_id=course_id_from_assetString(c)
-                break
-            # look for the string at start of the shortName
-            if c['originalName'].startswith(course_id) > 0:
-                course_id=course_id_from_assetString(c)
-                print("picked the course {} based on the starting match".format(c['shortName']))
-                break
-            # look for the substring in the shortName
-            if c['originalName'].find(course_id) > 0:
-                course_id=course_id_from_assetString(c)
-                print("picked the course {} based on partial match".format(c['shortName']))
-                break
+        if not c:
+            return None
 
+        course_id=course_id_from_assetString(c)
         print("processing course: {0} with course_id={1}".format(c['originalName'], course_id))
     return course_id
 
@@ -450,6 +493,28 @@ def main():
                       help="execute test code"
     )
 
+    parser.add_option('--cache',
+                      dest="cache",
+                      default=False,
+                      action="store_true",
+                      help="cache Canvas responses for an hour in .canvas_cache.sqlite (needs requests-cache)"
+    )
+
+    parser.add_option('--refresh-cache',
+                      dest="refresh_cache",
+                      default=False,
+                      action="store_true",
+                      help="empty the Canvas response cache before use"
+    )
+
+    parser.add_option('--format',
+                      dest="output_format",
+                      default='xlsx',
+                      type="choice",
+                      choices=['xlsx', 'csv', 'parquet'],
+                      help="format of the output file: xlsx (default), csv, or parquet (needs pyarrow)"
+    )
+
     options, remainder = parser.parse_args()
 
     Verbose_Flag=options.verbose
@@ -461,12 +526,14 @@ def main():
 
     ladok_session=initialize(options)
 
+    course_id=None
     course_code=None
     instance_code=None
     
     if (len(remainder) == 2):
         course_code=remainder[0]
         instance_code=remainder[1]
+        instance_info=ladok_session.instance_info(course_code, instance_code, 'en')
     elif (len(remainder) == 1):
         course_id=process_course_id_from_commandLine(remainder[0])
         if not course_id:
@@ -498,23 +565,16 @@ def main():
         print("Insuffient arguments - must provide course_code course_instance_id (i.e. the KOPPS Tillfällskod)\n")
         clean_exit(ladok_session)
 
-    utbildningstyp=ladok_session.utbildningstyp_JSON()
-    types_of_education=dict()
-    for i in utbildningstyp['Utbildningstyp']:
-        types_of_education[i['Kod']]={
-            'en': i['Benamning']['en'],
-            'sv': i['Benamning']['sv'],
-        }
-    if Verbose_Flag:
-        pprint.pprint(types_of_education, indent=4)
-
+    # the types of education do not depend on the course, so fetch them while we get the participants,
+    # the Ladok session has logged in by now, so the two threads cannot both start the login
+    startup_executor=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    types_of_education_future=startup_executor.submit(types_of_education_info, ladok_session)
+    startup_executor.shutdown(wait=False)
 
-    user_and_program_list=[]
-    #ii=ladok_session.instance_info(course_code, instance_code, 'en')
     # if the enstance code was not found or there is no Uid in the result, there is an error
-    if  not instance_info.get('Uid', False):
+    if not instance_info or not instance_info.get('Uid', False):
         print("It seems the instance code is not a Ladok instance ('tillfälleskod'), instance_info:")
-        pp.pprint(instance_info)
+        pprint.pprint(instance_info, indent=4)
         clean_exit(ladok_session)
     if Verbose_Flag:
         print("instance_info['Uid']={}".format(instance_info['Uid']))
@@ -522,22 +582,39 @@ def main():
     if Verbose_Flag:
         print("course_code={}".format(course_code))
 
-    pl=ladok_session.participants_JSON(instance_info['Uid'], participants_types=["not_started",  "ongoing", "registered", "finished", "cancelled"])
+    pl=ladok_session.participants_JSON(instance_info['Uid'], not_started=True, ongoing=True, registered=True, finished=True, cancelled=True)
     if Verbose_Flag:
         print("pl:")
-        pp.pprint(pl)
+        pprint.pprint(pl, indent=4)
     if not pl or len(pl) == 0:
         print("It seems there are no participants in this Ladok instance ('tillfälleskod')")
         clean_exit(ladok_session)
 
-    
-    for s in pl:
+    types_of_education=types_of_education_future.result()
+    if Verbose_Flag:
+        pprint.pprint(types_of_education, indent=4)
+
+
+    # the Canvas users of the students enrolled in the Canvas course are part of the enrollments,
+    # so we get them all at once and only look up the remaining students one by one
+    canvas_users_by_integration_id=dict()
+    if course_id:
+        for e in users_in_course(course_id):
+            user=e.get('user', {})
+            if user.get('integration_id'):
+                canvas_users_by_integration_id[user['integration_id']]=user
+
+    # the Ladok and Canvas lookups for one student do not depend on the other students,
+    # so we process the students in parallel
+    def student_row(s):
         d=dict()
 
         ladok_id=s['Student']['Uid']
-        si=specialization_info(ladok_session, ladok_id)
+        si=list(specialization_info(ladok_session, ladok_id)) # a copy, since the next line modifies it
         si=remove_cancelled_programs_from_student_information(si)
-        canvas_user_info=canvas_user_from_integration_id(ladok_id)
+        canvas_user_info=canvas_users_by_integration_id.get(ladok_id)
+        if not canvas_user_info:
+            canvas_user_info=canvas_user_from_integration_id(ladok_id)
         if canvas_user_info:
             d['canvas_user_id']=canvas_user_info['id']
             d['user']=canvas_user_info['sortable_name']
@@ -555,8 +632,10 @@ def main():
             d['program_name']=si0['program_name']
             d['Session_code']=si0['program_session_code']               # utbildningstillfälleskod
             # the type of education is associated with an application code (anmälningskod)
-            d['type_ of_education']=types_of_education[si0['program_type_code']]['en']
+            d['type_ of_education']=types_of_education[si0['program_type_code']][0]
             d['program_study_period_start']=si0['program_study_period']['Startdatum']
+        else:
+            d['program_name']="Self-contained courses - no program"
 
         if len(si) > 1:
             #print("more than one program for student: {0}, {1}".format(d['user'], si))
@@ -566,18 +645,26 @@ def main():
                 d['program_name'+'_'+str(i)]=si0['program_name']
                 d['Session_code'+'_'+str(i)]=si0['program_session_code']               # utbildningstillfälleskod
                 # the type of education is associated with an application code (anmälningskod)
-                d['type_ of_education'+'_'+str(i)]=types_of_education[si0['program_type_code']]['en']
+                d['type_ of_education'+'_'+str(i)]=types_of_education[si0['program_type_code']][0]
                 d['program_study_period_start'+'_'+str(i)]=si0['program_study_period']['Startdatum']
 
                 
-        user_and_program_list.append(d)
+        return d
+
+    # the rows are flat dicts, so they can go straight into the data frame
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        user_and_program_df=pd.DataFrame.from_records(executor.map(student_row, pl))
         
-    user_and_program_df=pd.json_normalize(user_and_program_list)
     output_file="users_programs-instance-{}".format(instance_code)
-    write_xlsx(output_file, user_and_program_df, 'users_programs')
+    if options.output_format == 'csv':
+        user_and_program_df.to_csv(output_file+'.csv', index=False)
+    elif options.output_format == 'parquet':
+        user_and_program_df.to_parquet(output_file+'.parquet', index=False)
+    else:
+        write_xlsx(output_file, user_and_program_df, 'users_programs')
 
-    # to logout and close the session
-    status=ladok_session.logout()
+    # to close the session
+    ladok_session.session.close()
 
 
 if __name__ == "__main__": main()